@@ -2,13 +2,19 @@ import streamlit as st
 import xarray as xr
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import cartopy.crs as ccrs
-import cartopy.feature as cfeature
+from matplotlib import colormaps
+from matplotlib.figure import Figure
+from matplotlib.image import AxesImage
+from matplotlib.markers import MarkerStyle
+import bisect
+import glob
 import heapq
+import io
+import math
 import requests
 import tempfile
 import os
+from concurrent.futures import ThreadPoolExecutor
 from scipy.ndimage import distance_transform_edt
 from matplotlib.path import Path
 from datetime import datetime, timezone, timedelta
@@ -40,20 +46,155 @@ OFFSHORE_COST = 10
 # ===============================
 # HYCOM 海流：逐小時時間序列 (time, lat, lon)
 # ===============================
+HYCOM_URL = "https://tds.hycom.org/thredds/dodsC/ESPC-D-V02/ice/2026"
 HYCOM_FORECAST_HOURS = 72  # 抓未來72小時的預報，涵蓋大多數航程長度
 
-@st.cache_data(ttl=3600)
+
+@st.cache_resource(ttl=6 * 3600)
+def open_hycom_dataset(url=HYCOM_URL):
+    """
+    開啟 HYCOM OPeNDAP 資料集並跨 rerun / 使用者共用同一個連線。
+    只持有 metadata，變數仍是延遲載入；ttl 讓時間軸能跟上每日新增的預報。
+    """
+    return xr.open_dataset(url, decode_times=False)
+
+
+HYCOM_TILE_STEP_DEG = 0.25  # bbox 對齊到 0.25° 格線，讓相近的範圍共用同一份快取
+
+
+def _quantize_bbox(bbox, step=HYCOM_TILE_STEP_DEG):
+    """把 bbox 往外對齊到 step 度的格線（只會放大、不會裁掉原本範圍）。"""
+    lat_min, lat_max, lon_min, lon_max = bbox
+    return (
+        float(np.floor(lat_min / step) * step), float(np.ceil(lat_max / step) * step),
+        float(np.floor(lon_min / step) * step), float(np.ceil(lon_max / step) * step),
+    )
+
+
+HYCOM_DISK_CACHE_DIR = os.path.join(tempfile.gettempdir(), "helios_hycom_tiles")
+HYCOM_TILE_TIME_PAD = 24  # 落地時往後多抓的時間切片數：時間視窗每小時往後移，同一個檔案仍涵蓋得到
+
+
+def hycom_run_tag(ds):
+    """預報 run 的識別：資料集時間軸的最後一筆，新一輪預報併入後就會改變。"""
+    return f"{float(ds['time'].values[-1]):.0f}"
+
+
+def _hycom_tile_path(ds, lat_min, lat_max, lon_min, lon_max):
+    """
+    磁碟快取檔名只看 bbox 與預報 run（資料集時間軸的最後一筆）：
+    同一輪預報只留一個檔，時間視窗讀回來再切；新一輪預報併入後檔名跟著改變。
+    回傳 (路徑, run_tag)。
+    """
+    run_tag = hycom_run_tag(ds)
+    name = f"{lat_min}_{lat_max}_{lon_min}_{lon_max}_{run_tag}.npz"
+    return os.path.join(HYCOM_DISK_CACHE_DIR, name), run_tag
+
+
+def _read_hycom_tile_file(path, t_start, t_stop):
+    """
+    從磁碟快取讀回 (lons, lats, u_ts, v_ts)，並切出時間索引 [t_start, t_stop)。
+    檔案不存在、損壞（例如寫到一半被中斷）或沒有涵蓋這個時間視窗時回傳 None。
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path) as z:
+            t0 = int(z["t0"])
+            u_all, v_all = z["u_ts"], z["v_ts"]
+            if t_start < t0 or t_stop > t0 + u_all.shape[0]:
+                return None
+            window = slice(t_start - t0, t_stop - t0)
+            return z["lons"], z["lats"], u_all[window], v_all[window]
+    except Exception:
+        return None
+
+
+def _write_hycom_tile_file(path, run_tag, t0, lons, lats, u_ts, v_ts):
+    """
+    先寫到暫存檔再 rename，其他 session 不會讀到寫到一半的檔案；
+    寫入成功後刪掉舊一輪預報的檔案，快取資料夾不會無限制長大。
+    寫不進去就只是少了磁碟快取，暫存檔一併清掉。
+    """
+    tmp_path = None
+    try:
+        os.makedirs(HYCOM_DISK_CACHE_DIR, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=HYCOM_DISK_CACHE_DIR, suffix=".tmp", delete=False) as tmp:
+            tmp_path = tmp.name
+            np.savez(tmp, t0=t0, lons=lons, lats=lats, u_ts=u_ts, v_ts=v_ts)
+        os.replace(tmp_path, path)
+    except OSError:
+        if tmp_path is not None:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        return
+
+    for name in os.listdir(HYCOM_DISK_CACHE_DIR):
+        if name.endswith(".npz") and not name.endswith(f"_{run_tag}.npz"):
+            try:
+                os.remove(os.path.join(HYCOM_DISK_CACHE_DIR, name))
+            except OSError:
+                pass
+
+
+def _fetch_hycom_tile(lat_min, lat_max, lon_min, lon_max, t_start, t_stop):
+    """
+    抓取指定範圍、時間索引 [t_start, t_stop) 的海流切片，只回傳 numpy 陣列。
+    結果落地成本機 .npz，TTL 過期或程式重啟後同一輪預報直接從磁碟讀回。
+    """
+    ds = open_hycom_dataset()
+    tile_path, run_tag = _hycom_tile_path(ds, lat_min, lat_max, lon_min, lon_max)
+    cached = _read_hycom_tile_file(tile_path, t_start, t_stop)
+    if cached is not None:
+        tile_lons, tile_lats, u_ts, v_ts = cached
+    else:
+        # 座標軸已在記憶體中，直接用 searchsorted 換算成索引區間，
+        # 以 isel 做純位置切片，省去 .sel 的標籤比對與座標驗證
+        lat_all = ds['lat'].values
+        lon_all = ds['lon'].values
+        j0, j1 = np.searchsorted(lat_all, lat_min, 'left'), np.searchsorted(lat_all, lat_max, 'right')
+        i0, i1 = np.searchsorted(lon_all, lon_min, 'left'), np.searchsorted(lon_all, lon_max, 'right')
+        fetch_stop = min(t_stop + HYCOM_TILE_TIME_PAD, ds['time'].size)
+        window = dict(time=slice(t_start, fetch_stop), lat=slice(j0, j1), lon=slice(i0, i1))
+
+        # float32 足以表示 m/s 等級的流速，快取與後續運算的記憶體用量減半
+        u_all = ds['ssu'].isel(window).values.astype(np.float32, copy=False)  # (T, lat, lon)
+        v_all = ds['ssv'].isel(window).values.astype(np.float32, copy=False)
+        tile_lons, tile_lats = lon_all[i0:i1], lat_all[j0:j1]
+        _write_hycom_tile_file(tile_path, run_tag, t_start, tile_lons, tile_lats, u_all, v_all)
+        u_ts, v_ts = u_all[:t_stop - t_start], v_all[:t_stop - t_start]
+
+    land_mask = np.all(np.isnan(u_ts), axis=0)
+    # 底圖用的流速大小跟著切片一起算好快取，畫圖時直接取對應時刻那一張
+    speed_ts = np.hypot(u_ts, v_ts)
+    return tile_lons, tile_lats, land_mask, u_ts, v_ts, speed_ts
+
+
+@st.cache_resource(ttl=3600, max_entries=16)
+def load_hycom_tile(lat_min, lat_max, lon_min, lon_max, t_start, t_stop):
+    """
+    以對齊後的 bbox 與時間索引為 key 快取海流切片，rerun 時不必再對 OPeNDAP 發出請求。
+    用 cache_resource 而非 cache_data：每次命中直接拿同一組陣列，
+    不必把好幾 MB 的 (T, lat, lon) 時間序列反序列化複製一份。
+    陣列跨 session 共用，設成唯讀，誤改會直接報錯而不是悄悄汙染其他使用者的資料。
+    """
+    tile = _fetch_hycom_tile(lat_min, lat_max, lon_min, lon_max, t_start, t_stop)
+    for arr in tile:
+        arr.flags.writeable = False
+    return tile
+
+
 def load_hycom_series(bbox=(21, 26, 118, 124), hours_ahead=HYCOM_FORECAST_HOURS):
     """
     回傳從「現在」開始，未來 hours_ahead 小時內的海流時間序列。
-    times_rel: 各時間切片相對於「現在」的小時數
-    u_ts, v_ts: shape = (T, lat, lon)
+    times_rel: 各時間切片相對於「現在」的小時數（每次 rerun 重新計算，不會隨快取變舊）
+    u_ts, v_ts, speed_ts: shape = (T, lat, lon)
     """
     now_utc = pd.Timestamp(datetime.now(timezone.utc))
-    lat_min, lat_max, lon_min, lon_max = bbox
-    url = "https://tds.hycom.org/thredds/dodsC/ESPC-D-V02/ice/2026"
     try:
-        ds = xr.open_dataset(url, decode_times=False)
+        ds = open_hycom_dataset()
     except Exception as e:
         st.error(f"無法連接到 HYCOM 數據庫: {e}")
         st.stop()
@@ -76,24 +217,18 @@ def load_hycom_series(bbox=(21, 26, 118, 124), hours_ahead=HYCOM_FORECAST_HOURS)
     valid_idx = valid_idx[valid_idx >= start_idx]
     if len(valid_idx) == 0:
         valid_idx = np.array([start_idx])
-    idx_slice = valid_idx
-
-    sub = ds.sel(lat=slice(lat_min, lat_max), lon=slice(lon_min, lon_max))
-    lons = sub.lon.values
-    lats = sub.lat.values
-
-    u_ts = sub['ssu'].isel(time=idx_slice).values  # (T, lat, lon)
-    v_ts = sub['ssv'].isel(time=idx_slice).values
-    times_used = time_vals[idx_slice]
-    times_rel = np.array([(t - now_utc).total_seconds() / 3600.0 for t in times_used])
+    t_start, t_stop = int(valid_idx[0]), int(valid_idx[-1]) + 1
 
-    land_mask = np.all(np.isnan(u_ts), axis=0)
+    lons, lats, land_mask, u_ts, v_ts, speed_ts = load_hycom_tile(*_quantize_bbox(bbox), t_start, t_stop)
+    times_used = time_vals[t_start:t_stop]
+    times_rel = np.asarray((times_used - now_utc).total_seconds() / 3600.0)
 
-    return lons, lats, land_mask, times_rel, times_used, u_ts, v_ts
+    return lons, lats, land_mask, times_rel, times_used, u_ts, v_ts, speed_ts
 
 
 with st.spinner("載入 HYCOM 海流時間序列中..."):
-    lons, lats, land_mask, hycom_times_rel, hycom_times_abs, hycom_u_ts, hycom_v_ts = load_hycom_series()
+    (lons, lats, land_mask, hycom_times_rel, hycom_times_abs,
+     hycom_u_ts, hycom_v_ts, hycom_speed_ts) = load_hycom_series()
 
 sea_mask = ~land_mask
 dist_to_land = distance_transform_edt(sea_mask)
@@ -102,16 +237,32 @@ _now_idx = int(np.argmin(np.abs(hycom_times_rel)))
 obs_time = hycom_times_abs[_now_idx]
 
 
+def nearest_time_idx(times, t):
+    """
+    times 為遞增的 Python list；用二分搜尋找出最接近 t 的索引（同距離時取較早的那筆，與 argmin 相同）。
+    每條 A* 邊都要查一次，避免對整條時間軸做 numpy 的 abs + argmin。
+    """
+    i = bisect.bisect_left(times, t)
+    if i == 0:
+        return 0
+    if i == len(times):
+        return len(times) - 1
+    return i if times[i] - t < t - times[i - 1] else i - 1
+
+
+_hycom_times_list = hycom_times_rel.tolist()
+
+
 def get_current_at(y, x, elapsed_hours):
     """依「從現在起算的航行時數」取得對應時間切片的海流值。"""
-    idx = int(np.argmin(np.abs(hycom_times_rel - elapsed_hours)))
+    idx = nearest_time_idx(_hycom_times_list, elapsed_hours)
     return float(hycom_u_ts[idx, y, x]), float(hycom_v_ts[idx, y, x])
 
 
 def get_current_snapshot(elapsed_hours):
-    """取得離 elapsed_hours 最近的整張海流快照 (u, v, 對應時刻, 索引)。用於底圖顯示。"""
-    idx = int(np.argmin(np.abs(hycom_times_rel - elapsed_hours)))
-    return hycom_u_ts[idx], hycom_v_ts[idx], hycom_times_abs[idx], idx
+    """取得離 elapsed_hours 最近的整張流速快照 (流速, 對應時刻, 索引)。用於底圖顯示。"""
+    idx = nearest_time_idx(_hycom_times_list, elapsed_hours)
+    return hycom_speed_ts[idx], hycom_times_abs[idx], idx
 
 
 # ===============================
@@ -127,6 +278,7 @@ def get_current_snapshot(elapsed_hours):
 # ===============================
 WEATHER_FORECAST_HOURS = 72          # 涵蓋未來 72 小時預報
 WEATHER_STEP_HOURS = 3               # GFS/GFS-Wave 預報時效間隔（f000, f003, f006, ...）
+WEATHER_FETCH_WORKERS = 4            # 同時向 NOMADS 發出的請求數
 
 
 def _find_latest_cycle():
@@ -151,6 +303,71 @@ def _find_latest_cycle():
     return None, None
 
 
+WEATHER_DISK_CACHE_DIR = os.path.join(tempfile.gettempdir(), "helios_gfs_grib")
+
+
+def _download_grib(url, cache_name):
+    """
+    下載 NOMADS 過濾後的 GRIB2 到本機快取資料夾並回傳路徑，失敗回傳 None。
+    同一輪 run 的同一個預報時效內容不會再變，檔案已存在就直接重用，
+    快取 TTL 過期或程式重啟後都不必再向 NOMADS 下載。
+    """
+    path = os.path.join(WEATHER_DISK_CACHE_DIR, cache_name)
+    if os.path.exists(path):
+        return path
+    r = requests.get(url, timeout=30)
+    if r.status_code != 200 or len(r.content) < 500:
+        return None
+    # 先寫暫存檔再 rename，其他執行緒 / session 不會讀到寫到一半的檔案；寫入失敗時暫存檔一併清掉
+    tmp_path = None
+    try:
+        os.makedirs(WEATHER_DISK_CACHE_DIR, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=WEATHER_DISK_CACHE_DIR, suffix=".tmp", delete=False) as tmp:
+            tmp_path = tmp.name
+            tmp.write(r.content)
+        os.replace(tmp_path, path)
+    except OSError:
+        if tmp_path is not None:
+            _remove_quietly(tmp_path)
+        return None
+    return path
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _discard_grib(path):
+    """
+    讀取失敗的快取檔刪掉（連同 cfgrib 寫在旁邊的 .idx 索引檔），
+    下次重新下載，不會一直卡在壞檔上。
+    """
+    if path is None:
+        return
+    for f in [path] + glob.glob(glob.escape(path) + ".*.idx"):
+        _remove_quietly(f)
+
+
+def _prune_grib_cache(date_str, cycle):
+    """
+    刪掉比「上一輪 run」更舊的 GRIB 與 .idx 檔，快取資料夾只保留目前與上一輪。
+    上一輪刻意留著：其他 session 可能還沒看到新一輪，正要開啟上一輪的檔案。
+    暫存檔（.tmp）可能是其他 session 正在寫入的，不動它。
+    """
+    if not os.path.isdir(WEATHER_DISK_CACHE_DIR):
+        return
+    run_start = datetime.strptime(date_str + cycle, "%Y%m%d%H")
+    keep = tuple(
+        (run_start - timedelta(hours=h)).strftime(".%Y%m%d.t%Hz.") for h in (0, 6)
+    )
+    for name in os.listdir(WEATHER_DISK_CACHE_DIR):
+        if name.endswith((".grib2", ".idx")) and not any(tag in name for tag in keep):
+            _remove_quietly(os.path.join(WEATHER_DISK_CACHE_DIR, name))
+
+
 def _fetch_wave_step(date_str, cycle, fhr):
     """抓單一預報時效（fhr, 小時）的波浪資料，失敗回傳 None。"""
     f_str = f"f{fhr:03d}"
@@ -162,28 +379,26 @@ def _fetch_wave_step(date_str, cycle, fhr):
         "&leftlon=118&rightlon=124&toplat=26&bottomlat=21"
         f"&dir=%2Fgfs.{date_str}%2F{cycle}%2Fwave%2Fgridded"
     )
+    grib_path = None
     try:
-        r = requests.get(url, timeout=30)
-        if r.status_code != 200 or len(r.content) < 500:
+        grib_path = _download_grib(url, f"gfswave.{date_str}.t{cycle}z.{f_str}.grib2")
+        if grib_path is None:
             return None
-        with tempfile.NamedTemporaryFile(suffix=".grib2", delete=False) as tmp:
-            tmp.write(r.content)
-            tmp_path = tmp.name
         ds_w = xr.open_dataset(
-            tmp_path, engine="cfgrib",
+            grib_path, engine="cfgrib",
             filter_by_keys={"stepRange": str(fhr), "typeOfLevel": "surface"}
         )
-        swh_grid = ds_w["swh"].values
+        swh_grid = ds_w["swh"].values.astype(np.float32, copy=False)
         wlats = ds_w["latitude"].values
         wlons = ds_w["longitude"].values
         try:
-            dirpw_grid = ds_w["dirpw"].values
+            dirpw_grid = ds_w["dirpw"].values.astype(np.float32, copy=False)
         except Exception:
             dirpw_grid = None
         ds_w.close()
-        os.unlink(tmp_path)
         return {"swh_grid": swh_grid, "dirpw_grid": dirpw_grid, "lats": wlats, "lons": wlons}
     except Exception:
+        _discard_grib(grib_path)
         return None
 
 
@@ -197,25 +412,23 @@ def _fetch_wind_step(date_str, cycle, fhr):
         "&subregion=&leftlon=118&rightlon=124&toplat=26&bottomlat=21"
         f"&dir=%2Fgfs.{date_str}%2F{cycle}%2Fatmos"
     )
+    grib_path = None
     try:
-        r = requests.get(url, timeout=30)
-        if r.status_code != 200 or len(r.content) < 500:
+        grib_path = _download_grib(url, f"gfs.{date_str}.t{cycle}z.f{f_str}.grib2")
+        if grib_path is None:
             return None
-        with tempfile.NamedTemporaryFile(suffix=".grib2", delete=False) as tmp:
-            tmp.write(r.content)
-            tmp_path = tmp.name
         ds_f = xr.open_dataset(
-            tmp_path, engine="cfgrib",
+            grib_path, engine="cfgrib",
             filter_by_keys={"typeOfLevel": "heightAboveGround", "level": 10}
         )
-        u = ds_f["u10"].values
-        v = ds_f["v10"].values
+        u = ds_f["u10"].values.astype(np.float32, copy=False)
+        v = ds_f["v10"].values.astype(np.float32, copy=False)
         wlats = ds_f["latitude"].values
         wlons = ds_f["longitude"].values
         ds_f.close()
-        os.unlink(tmp_path)
-        return {"u": u, "v": v, "speed": np.sqrt(u**2 + v**2), "lats": wlats, "lons": wlons}
+        return {"u": u, "v": v, "speed": np.hypot(u, v), "lats": wlats, "lons": wlons}
     except Exception:
+        _discard_grib(grib_path)
         return None
 
 
@@ -234,13 +447,16 @@ def fetch_weather_series(forecast_hours=WEATHER_FORECAST_HOURS, step_hours=WEATH
     date_str, cycle = _find_latest_cycle()
     if not date_str:
         return None
+    _prune_grib_cache(date_str, cycle)
 
     fhrs = list(range(0, forecast_hours + 1, step_hours))
-    wave_steps = []
-    wind_steps = []
-    for fhr in fhrs:
-        wave_steps.append(_fetch_wave_step(date_str, cycle, fhr))
-        wind_steps.append(_fetch_wind_step(date_str, cycle, fhr))
+    # 每個預報時效都是獨立的 HTTP 請求，時間幾乎都花在等網路；
+    # 用少量執行緒同時抓（數量刻意壓低，避免觸發 NOMADS 的流量限制），結果順序與 fhrs 相同
+    with ThreadPoolExecutor(max_workers=WEATHER_FETCH_WORKERS) as ex:
+        wave_futs = [ex.submit(_fetch_wave_step, date_str, cycle, fhr) for fhr in fhrs]
+        wind_futs = [ex.submit(_fetch_wind_step, date_str, cycle, fhr) for fhr in fhrs]
+        wave_steps = [f.result() for f in wave_futs]
+        wind_steps = [f.result() for f in wind_futs]
 
     # run 開始時刻（cycle 那一刻）相對於「現在」的小時差，
     # 讓 times_rel 對齊到跟海流一樣的「現在 = 0」基準
@@ -264,35 +480,92 @@ with st.spinner("載入氣象（風/浪）時間序列中..."):
     weather_series = fetch_weather_series()
 
 
-def _nearest_step_idx(times_rel, elapsed_hours):
-    return int(np.argmin(np.abs(times_rel - elapsed_hours)))
+def _attach_hycom_index(steps):
+    """
+    替每筆風/浪網格預先算好「HYCOM 格點 → 該網格最近格點」的索引表 (yi, xj)，
+    之後成本函數只需查表，不必每段航線都對整條座標軸做 argmin。
+    """
+    for g in steps:
+        if g is not None:
+            g["yi"] = np.abs(g["lats"][None, :] - lats[:, None]).argmin(axis=1)
+            g["xj"] = np.abs(g["lons"][None, :] - lons[:, None]).argmin(axis=1)
+
+
+def _nearest_valid_steps(steps):
+    """
+    對每個時間索引預先找出最近一筆抓取成功的資料（同距離時取較早的那筆），
+    查詢時不必每次排序、逐筆往前後找。全部失敗時回傳全 None。
+    """
+    valid = [i for i, g in enumerate(steps) if g is not None]
+    if not valid:
+        return [None] * len(steps)
+    return [steps[min(valid, key=lambda j: abs(j - i))] for i in range(len(steps))]
+
+
+def _attach_wave_direction(steps):
+    """
+    波浪「前進方向」的單位向量 (東向, 北向) 整張網格一次算好（dirpw 是來向，+180° 轉成去向），
+    成本函數每段只需查表做內積，不必每段都重算 radians / sin / cos。
+    """
+    for g in steps:
+        if g is not None and g.get("dirpw_grid") is not None:
+            to_rad = np.radians(g["dirpw_grid"] + 180.0)
+            g["wave_dir_lon"] = np.sin(to_rad)
+            g["wave_dir_lat"] = np.cos(to_rad)
+
+
+@st.cache_resource(ttl=3600, max_entries=4)
+def build_weather_lookups(date_str, cycle, fetched_key, grid_key, _weather_series):
+    """
+    風/浪的查表資料（HYCOM 索引表、波浪去向單位向量、各時間索引對應的有效資料）
+    依（run、抓取成功的時效、HYCOM 網格）只算一次，跨 rerun / session 共用。
+    fetch_weather_series 是 cache_data，每次 rerun 拿到的都是反序列化的新副本，
+    直接寫進那份 dict 的話每次 full rerun 都得重算。
+    _weather_series 不參與雜湊：同一組 key 的網格內容相同，不必每次雜湊好幾 MB 的陣列。
+    """
+    wave_steps = [dict(g) if g is not None else None for g in _weather_series["wave_steps"]]
+    wind_steps = [dict(g) if g is not None else None for g in _weather_series["wind_steps"]]
+    _attach_hycom_index(wave_steps)
+    _attach_wave_direction(wave_steps)
+    _attach_hycom_index(wind_steps)
+    return {
+        "wave_lookup": _nearest_valid_steps(wave_steps),
+        "wind_lookup": _nearest_valid_steps(wind_steps),
+    }
+
+
+if weather_series is not None:
+    _lookups = build_weather_lookups(
+        weather_series["date"], weather_series["cycle"],
+        (tuple(g is not None for g in weather_series["wave_steps"]),
+         tuple(g is not None for g in weather_series["wind_steps"])),
+        (len(lats), len(lons), float(lats[0]), float(lons[0])),
+        weather_series,
+    )
+    weather_series["times_list"] = weather_series["times_rel"].tolist()
+    weather_series["wave_lookup"] = _lookups["wave_lookup"]
+    weather_series["wind_lookup"] = _lookups["wind_lookup"]
+
+
+def get_weather_at(elapsed_hours):
+    """
+    依「從現在起算的航行時數」同時取得對應時間切片的 (波浪, 風場) 網格，找不到的回傳 None。
+    時間索引只算一次；若最接近的那筆抓取失敗，改用前後最近一筆有效資料。
+    """
+    if weather_series is None:
+        return None, None
+    idx = nearest_time_idx(weather_series["times_list"], elapsed_hours)
+    return weather_series["wave_lookup"][idx], weather_series["wind_lookup"][idx]
 
 
 def get_wave_at(elapsed_hours):
     """依「從現在起算的航行時數」取得對應時間切片的波浪資料（整張網格）。找不到回傳 None。"""
-    if weather_series is None:
-        return None
-    idx = _nearest_step_idx(weather_series["times_rel"], elapsed_hours)
-    # 若最接近的那筆抓取失敗，往前後找最近一筆有效資料
-    n = len(weather_series["wave_steps"])
-    order = sorted(range(n), key=lambda i: abs(i - idx))
-    for i in order:
-        if weather_series["wave_steps"][i] is not None:
-            return weather_series["wave_steps"][i]
-    return None
+    return get_weather_at(elapsed_hours)[0]
 
 
 def get_wind_at(elapsed_hours):
     """依「從現在起算的航行時數」取得對應時間切片的風場資料（整張網格）。找不到回傳 None。"""
-    if weather_series is None:
-        return None
-    idx = _nearest_step_idx(weather_series["times_rel"], elapsed_hours)
-    n = len(weather_series["wind_steps"])
-    order = sorted(range(n), key=lambda i: abs(i - idx))
-    for i in order:
-        if weather_series["wind_steps"][i] is not None:
-            return weather_series["wind_steps"][i]
-    return None
+    return get_weather_at(elapsed_hours)[1]
 
 
 # ===============================
@@ -307,10 +580,6 @@ with st.sidebar:
     e_lat = st.number_input("End Lat", 21.0, 26.0, 24.5967)       # 蘇澳港
     ship_speed = st.number_input("Ship Speed (km/h)", 1.0, 60.0, 20.0)
 
-    st.divider()
-    progress_pct = st.slider("航行進度 (%)", 0, 100, 0, key="progress_slider")
-    st.caption("拖動上方滑桿即可查看船舶航行至該進度時，對應時刻的風/浪/流底圖與剩餘資訊。")
-
     st.divider()
     st.subheader("🧬 船型自適應環境優化模式")
 
@@ -362,6 +631,17 @@ SHIP_PARAMS = {
 }
 wave_severity = 3.0 if ship_type_key == 'CargoTanker' else 1.0
 
+# 航線規劃與航程積分用到的船型/船速參數：明確傳進成本函數，不從全域變數讀，
+# plan_route 的快取 key 就是實際的輸入，之後新增參數也不會漏掉
+cost_params = {
+    "ship_type_key": ship_type_key,
+    "ship_speed": ship_speed,
+    "w_curr": w_curr,
+    "w_wind": w_wind,
+    "w_wave": w_wave,
+    "wave_severity": wave_severity,
+}
+
 MAX_CURRENT_BONUS = 2.0
 MAX_WIND_BONUS = 3.0
 
@@ -371,11 +651,23 @@ MAX_WIND_BONUS = 3.0
 def nearest_cell(lon, lat):
     return (np.abs(lats - lat).argmin(), np.abs(lons - lon).argmin())
 
+def polygon_grid_mask(polygons):
+    """
+    一次判斷整張 HYCOM 網格有哪些格點落在任一多邊形內，回傳 (lat, lon) 的布林陣列。
+    格點以 (lon, lat) 和多邊形頂點比對，判斷方式與原本逐點的 contains_point 相同。
+    """
+    lon_g, lat_g = np.meshgrid(lons, lats)
+    pts = np.column_stack([lon_g.ravel(), lat_g.ravel()])
+    mask = np.zeros(len(pts), dtype=bool)
+    for zone in polygons:
+        mask |= Path(np.asarray(zone)).contains_points(pts)
+    return mask.reshape(lat_g.shape)
+
+
+offshore_mask = polygon_grid_mask(OFFSHORE_WIND)
+
 def offshore_penalty(y, x):
-    for zone in OFFSHORE_WIND:
-        if Path(zone).contains_point([lons[x], lats[y]]):
-            return OFFSHORE_COST
-    return 0
+    return OFFSHORE_COST if offshore_mask[y, x] else 0
 
 # ===============================
 # 離岸安全距離：用實際公里數校正
@@ -386,104 +678,134 @@ _lon_res = float(np.abs(np.diff(lons)).mean()) if len(lons) > 1 else 0.05
 CELL_KM = ((_lat_res + _lon_res) / 2) * 111.0
 COAST_SAFE_CELLS = max(3.0, COAST_SAFE_KM / max(CELL_KM, 1e-6))
 COAST_PENALTY_WEIGHT = 30
+_COAST_PENALTY_SCALE = COAST_PENALTY_WEIGHT / (COAST_SAFE_CELLS * COAST_SAFE_CELLS)
+# 離岸懲罰只跟格點到陸地的距離有關，整張網格一次算好，A* 每條邊只需查表
+_coast_gap = np.clip(COAST_SAFE_CELLS - dist_to_land, 0, None)
+coast_penalty_grid = _coast_gap * _coast_gap * _coast_gap * _COAST_PENALTY_SCALE
 
 def coast_penalty(y, x):
-    d = dist_to_land[y, x]
-    if d >= COAST_SAFE_CELLS:
-        return 0
-    return ((COAST_SAFE_CELLS - d) ** 3) * COAST_PENALTY_WEIGHT / (COAST_SAFE_CELLS ** 2)
+    return coast_penalty_grid[y, x]
+
+_goal_dist_tables = {}
 
-def heuristic(y, x, goal):
-    d = np.hypot(lats[y] - lats[goal[0]], lons[x] - lons[goal[1]]) * 111
-    return d * SHIP_PARAMS[ship_type_key]['distance_factor'] * 0.9
+def goal_distance_km(goal):
+    """
+    整張網格到 goal 的直線距離表 (lat, lon)，單位 km；每個終點只算一次。
+    A* 的啟發函數與前進量懲罰每條邊都要查，查表取代逐格 hypot。
+    """
+    table = _goal_dist_tables.get(goal)
+    if table is None:
+        table = np.hypot(lats[:, None] - lats[goal[0]], lons[None, :] - lons[goal[1]]) * 111
+        _goal_dist_tables[goal] = table
+    return table
+
+def heuristic(y, x, goal, cp):
+    d = goal_distance_km(goal)[y, x]
+    return d * SHIP_PARAMS[cp["ship_type_key"]]['distance_factor'] * 0.9
 
 # ===============================
 # 綜合成本函數 — 風、浪、流皆依 elapsed_hours 查對應時間切片
+# 每條 A* 邊都會呼叫，單一數值的運算一律用 math（numpy ufunc 對純量的呼叫成本高得多）
 # ===============================
-def get_comprehensive_cost(y0, x0, y1, x1, goal, elapsed_hours):
+def segment_physics(y0, x0, y1, x1, elapsed_hours, cp):
+    """
+    A* 成本與剩餘航程共用的單段物理量：依 elapsed_hours 查對應時刻的風、浪、流，
+    船型與船速取自 cp（cost_params），回傳 (距離 km, 海流加成, 風向投影, 波浪成本因子 swh²·(1-波向投影), 有效航速 km/h)。
+    兩格重合（距離為 0）時回傳 None。
+    """
     dlat = lats[y1] - lats[y0]
     dlon = lons[x1] - lons[x0]
-    norm = np.hypot(dlat, dlon)
+    norm = math.hypot(dlat, dlon)
     if norm == 0:
-        return 0, 0.0
+        return None
     dir_lat = dlat / norm
     dir_lon = dlon / norm
     base_dist = norm * 111
 
-    p = SHIP_PARAMS[ship_type_key]
-    distance_factor = p['distance_factor']
+    p = SHIP_PARAMS[cp["ship_type_key"]]
     current_gain    = p['current_gain']
-    wind_gain       = p['wind_gain']
     wind_speed_gain = p['wind_speed_gain']
-    time_weight     = p['time_weight']
-    fuel_weight     = p['fuel_weight']
-    progress_weight = p['progress_weight']
     wave_coef       = p['wave_coef']
 
-    progress_penalty = 0
-    if goal is not None:
-        d_before = np.hypot(lats[y0]-lats[goal[0]], lons[x0]-lons[goal[1]]) * 111
-        d_after  = np.hypot(lats[y1]-lats[goal[0]], lons[x1]-lons[goal[1]]) * 111
-        forward_progress = d_before - d_after
-        progress_penalty = max(base_dist - forward_progress, 0) * progress_weight * 0.3
-
     # 海流：依 elapsed_hours 對應的時間切片
     current_proj = 0.0
     u_cur, v_cur = get_current_at(y0, x0, elapsed_hours)
-    if not np.isnan(u_cur) and not np.isnan(v_cur):
+    if not math.isnan(u_cur) and not math.isnan(v_cur):
         current_proj = (u_cur * dir_lon + v_cur * dir_lat) * 3.6
     current_bonus = min(max(current_proj, -MAX_CURRENT_BONUS), MAX_CURRENT_BONUS)
-    current_cost = -current_bonus * current_gain
 
-    # 🆕 風場：依 elapsed_hours 對應的時間切片
+    # 🆕 風場：依 elapsed_hours 對應的時間切片（風、浪同一次查表取得）
     wind_proj = 0.0
-    wind_cost = 0.0
-    wnd = get_wind_at(elapsed_hours)
+    w, wnd = get_weather_at(elapsed_hours)
     if wnd:
-        wi = np.abs(wnd["lats"] - lats[y0]).argmin()
-        wj = np.abs(wnd["lons"] - lons[x0]).argmin()
+        wi = wnd["yi"][y0]
+        wj = wnd["xj"][x0]
         wind_proj = (float(wnd["u"][wi, wj]) * dir_lon +
                      float(wnd["v"][wi, wj]) * dir_lat) * 3.6
-        wind_bonus = min(max(wind_proj, -MAX_WIND_BONUS), MAX_WIND_BONUS)
-        wind_cost = -wind_bonus * wind_gain
 
     # 🆕 波浪：依 elapsed_hours 對應的時間切片
-    wave_cost = 0.0
+    wave_factor = 0.0
     wave_slowdown = 1.0
-    wave_proj = 0.0
-    w = get_wave_at(elapsed_hours)
     if w:
-        wi = np.abs(w["lats"] - lats[y0]).argmin()
-        wj = np.abs(w["lons"] - lons[x0]).argmin()
+        wi = w["yi"][y0]
+        wj = w["xj"][x0]
         swh = w["swh_grid"][wi, wj]
-        if not np.isnan(swh) and swh > 0:
+        if not math.isnan(swh) and swh > 0:
             dirpw_grid = w.get("dirpw_grid")
-            has_dir = dirpw_grid is not None and not np.isnan(dirpw_grid[wi, wj])
+            has_dir = dirpw_grid is not None and not math.isnan(dirpw_grid[wi, wj])
             if has_dir:
-                wave_dir_rad = np.radians(dirpw_grid[wi, wj] + 180.0)
-                wave_dir_lon = np.sin(wave_dir_rad)
-                wave_dir_lat = np.cos(wave_dir_rad)
-                wave_proj = wave_dir_lon * dir_lon + wave_dir_lat * dir_lat
+                wave_proj = (w["wave_dir_lon"][wi, wj] * dir_lon +
+                             w["wave_dir_lat"][wi, wj] * dir_lat)
                 wave_slowdown = 1.0 - wave_proj * swh * wave_coef
                 wave_slowdown = max(0.5, min(wave_slowdown, 1.5))
+                wave_factor = swh * swh * max(1.0 - wave_proj, 0)
             else:
                 wave_slowdown = 1.0 + swh * wave_coef
-            wave_cost = swh ** 2 * wave_severity * max(
-                1.0 - wave_proj if has_dir else 1.0, 0)
+                wave_factor = swh * swh
 
-    effective_speed = (ship_speed + current_bonus * current_gain +
+    effective_speed = (cp["ship_speed"] + current_bonus * current_gain +
                         wind_proj * wind_speed_gain * 0.5) / wave_slowdown
     effective_speed = max(effective_speed, 2.0)
 
+    return base_dist, current_bonus, wind_proj, wave_factor, effective_speed
+
+
+def get_comprehensive_cost(y0, x0, y1, x1, goal, elapsed_hours, cp):
+    seg = segment_physics(y0, x0, y1, x1, elapsed_hours, cp)
+    if seg is None:
+        return 0, 0.0
+    base_dist, current_bonus, wind_proj, wave_factor, effective_speed = seg
+
+    p = SHIP_PARAMS[cp["ship_type_key"]]
+    distance_factor = p['distance_factor']
+    current_gain    = p['current_gain']
+    wind_gain       = p['wind_gain']
+    time_weight     = p['time_weight']
+    fuel_weight     = p['fuel_weight']
+    progress_weight = p['progress_weight']
+
+    progress_penalty = 0
+    if goal is not None:
+        goal_dist = goal_distance_km(goal)
+        forward_progress = goal_dist[y0, x0] - goal_dist[y1, x1]
+        progress_penalty = max(base_dist - forward_progress, 0) * progress_weight * 0.3
+
+    current_cost = -current_bonus * current_gain
+    wind_cost = 0.0
+    if wind_proj:
+        wind_bonus = min(max(wind_proj, -MAX_WIND_BONUS), MAX_WIND_BONUS)
+        wind_cost = -wind_bonus * wind_gain
+    wave_cost = wave_factor * cp["wave_severity"]
+
     segment_time_hours = base_dist / effective_speed
     time_cost = segment_time_hours * time_weight
     fuel_cost = (40 + 0.5 * effective_speed) * segment_time_hours * fuel_weight
 
     total_cost = (
         base_dist * distance_factor +
-        current_cost * w_curr +
-        wind_cost * w_wind +
-        wave_cost * w_wave +
+        current_cost * cp["w_curr"] +
+        wind_cost * cp["w_wind"] +
+        wave_cost * cp["w_wave"] +
         time_cost + fuel_cost +
         progress_penalty +
         coast_penalty(y1, x1)
@@ -495,22 +817,24 @@ def get_comprehensive_cost(y0, x0, y1, x1, goal, elapsed_hours):
 # ===============================
 dirs = [(1,0), (-1,0), (0,1), (0,-1), (1,1), (1,-1), (-1,1), (-1,-1)]
 
-def astar(start, goal):
+def astar(start, goal, cp):
     rows, cols = land_mask.shape
-    pq = [(heuristic(start[0], start[1], goal), start)]
+    pq = [(heuristic(start[0], start[1], goal, cp), start, 0)]
     came = {}
     cost = {start: 0}
     elapsed_time = {start: 0.0}
 
     while pq:
-        _, cur = heapq.heappop(pq)
+        _, cur, g = heapq.heappop(pq)
         if cur == goal:
             break
+        if g > cost[cur]:
+            continue  # 之後已找到更短的路徑到這格，這筆是過期的堆積項目，不必再展開鄰居
         for d in dirs:
             ni, nj = cur[0]+d[0], cur[1]+d[1]
             if 0 <= ni < rows and 0 <= nj < cols and not land_mask[ni, nj]:
                 step_cost, seg_time = get_comprehensive_cost(
-                    cur[0], cur[1], ni, nj, goal, elapsed_time[cur]
+                    cur[0], cur[1], ni, nj, goal, elapsed_time[cur], cp
                 )
                 step_cost += offshore_penalty(ni, nj)
 
@@ -520,8 +844,8 @@ def astar(start, goal):
                     cost[(ni, nj)] = new_g
                     elapsed_time[(ni, nj)] = elapsed_time[cur] + seg_time
                     came[(ni, nj)] = cur
-                    f = new_g + heuristic(ni, nj, goal)
-                    heapq.heappush(pq, (f, (ni, nj)))
+                    f = new_g + heuristic(ni, nj, goal, cp)
+                    heapq.heappush(pq, (f, (ni, nj), new_g))
 
     path = []
     cur = goal
@@ -535,244 +859,366 @@ def astar(start, goal):
 # ===============================
 # Route Logic
 # ===============================
-if "full_path" not in st.session_state:
-    st.session_state.full_path = []
-if "ship_step_idx" not in st.session_state:
-    st.session_state.ship_step_idx = 0
-if "route_key" not in st.session_state:
-    st.session_state.route_key = None
+for _k, _v in {"full_path": [], "ship_step_idx": 0, "route_key": None}.items():
+    st.session_state.setdefault(_k, _v)
+
+# 目前載入的海流/風浪預報版本：HYCOM 用與磁碟快取相同的 run tag，
+# 再加上時間視窗起點（times_rel 以「現在」為 0，視窗往後移時同一條航線的對應時刻也會變）；
+# 預報更新後快取的航線與航程積分都要重算
+forecast_key = (
+    hycom_run_tag(open_hycom_dataset()),
+    str(hycom_times_abs[0]),
+    (weather_series["date"], weather_series["cycle"]) if weather_series else None,
+)
+
+
+@st.cache_data(ttl=3600, max_entries=64, show_spinner=False)
+def plan_route(start, goal, cost_params, forecast_key):
+    """
+    A* 航線依（起訖格點、船型/船速參數、預報版本）快取，跨 session 共用；
+    切回先前用過的起訖點或船型時直接取用，不必重跑整個搜尋。
+    船型與船速相關的輸入全部經由 cost_params 傳入；forecast_key 對應目前載入的
+    海流/風浪資料，ttl 與海流、風浪的快取一致，過期的預報不會一直留在快取裡。
+    """
+    return [(int(y), int(x)) for y, x in astar(start, goal, cost_params)]
+
 
-start = nearest_cell(s_lon, s_lat)
-goal  = nearest_cell(e_lon, e_lat)
+start = tuple(int(v) for v in nearest_cell(s_lon, s_lat))
+goal  = tuple(int(v) for v in nearest_cell(e_lon, e_lat))
 
 route_key = (s_lon, s_lat, e_lon, e_lat, ship_mode)
 
-if st.session_state.route_key != route_key:
+if st.session_state.route_key != route_key or "path_lons" not in st.session_state:
+    # 終點落在陸地格點時 A* 永遠到不了，會把整片海域展開完才失敗；先用網格查表直接擋下
+    if land_mask[goal]:
+        st.error("❌ 終點位於陸地（或 HYCOM 無海流資料的格點），請調整終點座標")
+        st.stop()
     with st.spinner("HELIOS 尋路引擎正依據船型特徵與逐時風浪流變化進行最優解算..."):
-        new_path = astar(start, goal)
+        new_path = plan_route(start, goal, cost_params, forecast_key)
     if len(new_path) == 0:
         st.error("❌ 無法在當前海況與船型設定下找到安全航線")
         st.stop()
     st.session_state.full_path = new_path
+    # 畫圖用的航線經緯度另存成兩條連續陣列（SoA），rerun 時直接切片，不必再從格點 tuple 轉換
+    path_idx = np.asarray(new_path)
+    st.session_state.path_lons = lons[path_idx[:, 1]]
+    st.session_state.path_lats = lats[path_idx[:, 0]]
     st.session_state.ship_step_idx = 0
     st.session_state.route_key = route_key
 
 path = st.session_state.full_path
-
-if path:
-    st.session_state.ship_step_idx = min(st.session_state.ship_step_idx, len(path)-1)
-
-if path:
-    slider_idx = int((progress_pct / 100) * (len(path) - 1))
-    st.session_state.ship_step_idx = slider_idx
-
 if not path:
     st.stop()
 
-current_pos = path[st.session_state.ship_step_idx]
-
 # ===============================
 # Calculations — 剩餘距離/時間，逐段依對應時刻查風浪流
 # ===============================
-def calc_segment(y0, x0, y1, x1, elapsed_hours):
-    p = SHIP_PARAMS[ship_type_key]
-    current_gain    = p['current_gain']
-    wind_speed_gain = p['wind_speed_gain']
-    wave_coef       = p['wave_coef']
-
-    seg_dist = np.hypot(lats[y1]-lats[y0], lons[x1]-lons[x0]) * 111
-    dlat = lats[y1] - lats[y0]
-    dlon = lons[x1] - lons[x0]
-    norm = np.hypot(dlat, dlon)
-    if norm == 0:
+def calc_segment(y0, x0, y1, x1, elapsed_hours, cp):
+    seg = segment_physics(y0, x0, y1, x1, elapsed_hours, cp)
+    if seg is None:
         return 0.0, 0.0
+    seg_dist, effective_speed = seg[0], seg[-1]
+    return seg_dist, seg_dist / effective_speed
 
-    dir_lat = dlat / norm
-    dir_lon = dlon / norm
 
-    current_proj = 0.0
-    u_cur, v_cur = get_current_at(y0, x0, elapsed_hours)
-    if not np.isnan(u_cur) and not np.isnan(v_cur):
-        current_proj = (u_cur * dir_lon + v_cur * dir_lat) * 3.6
-    current_bonus = min(max(current_proj, -MAX_CURRENT_BONUS), MAX_CURRENT_BONUS)
+def integrate_voyage(path, cp):
+    """
+    沿整條航線一次算完各段的距離/時間，以及抵達每個航點時的累積航行時數。
+    剩餘距離/時間也先做成後綴和（第 i 個元素 = 從第 i 個航點到終點），
+    拖動「航行進度」滑桿只需要查表，不必每次 rerun 重新加總。
+    """
+    n_seg = max(len(path) - 1, 0)
+    seg_dist = np.zeros(n_seg)
+    seg_time = np.zeros(n_seg)
+    elapsed = 0.0
+    for i in range(n_seg):
+        y0, x0 = path[i]
+        y1, x1 = path[i + 1]
+        seg_dist[i], seg_time[i] = calc_segment(y0, x0, y1, x1, elapsed, cp)
+        elapsed += seg_time[i]
+    arrive_hours = np.concatenate(([0.0], np.cumsum(seg_time)))
+    remain_dist = np.concatenate((np.cumsum(seg_dist[::-1])[::-1], [0.0]))
+    remain_time = np.concatenate((np.cumsum(seg_time[::-1])[::-1], [0.0]))
 
-    wind_proj = 0.0
-    wnd = get_wind_at(elapsed_hours)
-    if wnd:
-        wi = np.abs(wnd["lats"] - lats[y0]).argmin()
-        wj = np.abs(wnd["lons"] - lons[x0]).argmin()
-        wind_proj = (float(wnd["u"][wi, wj]) * dir_lon +
-                     float(wnd["v"][wi, wj]) * dir_lat) * 3.6
+    # 各航點往下一點的航向一次向量化算完；終點沒有下一段，航向記為 0
+    path_idx = np.asarray(path).reshape(-1, 2)
+    heading = np.zeros(len(path))
+    heading[:n_seg] = np.degrees(np.arctan2(np.diff(lats[path_idx[:, 0]]),
+                                            np.diff(lons[path_idx[:, 1]])))
+    return remain_dist, remain_time, arrive_hours, heading
 
-    wave_slowdown = 1.0
-    w = get_wave_at(elapsed_hours)
-    if w:
-        wi = np.abs(w["lats"] - lats[y0]).argmin()
-        wj = np.abs(w["lons"] - lons[x0]).argmin()
-        swh = w["swh_grid"][wi, wj]
-        if not np.isnan(swh) and swh > 0:
-            dirpw_grid = w.get("dirpw_grid")
-            has_dir = dirpw_grid is not None and not np.isnan(dirpw_grid[wi, wj])
-            if has_dir:
-                wave_dir_rad = np.radians(dirpw_grid[wi, wj] + 180.0)
-                wave_proj = (np.sin(wave_dir_rad) * dir_lon +
-                             np.cos(wave_dir_rad) * dir_lat)
-                wave_slowdown = 1.0 - wave_proj * swh * wave_coef
-                wave_slowdown = max(0.5, min(wave_slowdown, 1.5))
-            else:
-                wave_slowdown = 1.0 + swh * wave_coef
 
-    effective_speed = (ship_speed + current_bonus * current_gain +
-                        wind_proj * wind_speed_gain * 0.5) / wave_slowdown
-    effective_speed = max(effective_speed, 2.0)
+def calc_remaining(idx, voyage):
+    remain_dist, remain_time, arrive_hours, heading = voyage
+    elapsed_at_current = float(arrive_hours[idx])  # 🆕 船抵達目前位置時，從現在算起已經過的小時數
+    return float(remain_dist[idx]), float(remain_time[idx]), float(heading[idx]), elapsed_at_current
 
-    seg_time = seg_dist / effective_speed
-    return seg_dist, seg_time
 
+# 航線、船速或載入的預報資料改變時才重新積分整條航程
+voyage_key = (route_key, tuple(cost_params.items()), len(path), forecast_key)
+if st.session_state.get("voyage_key") != voyage_key:
+    st.session_state.voyage = integrate_voyage(path, cost_params)
+    st.session_state.voyage_key = voyage_key
 
-def calc_remaining(path, idx):
-    elapsed = 0.0
-    for i in range(0, idx):
-        y0, x0 = path[i]
-        y1, x1 = path[i + 1]
-        _, seg_time = calc_segment(y0, x0, y1, x1, elapsed)
-        elapsed += seg_time
+# ===============================
+# Map — 底圖依「船目前預計時刻」對應的風/浪/流資料繪製
+# ===============================
+# Cartopy（連帶 pyproj / shapely）匯入很慢，延到真正要畫地圖時才載入；
+# 冷啟動時標題、側邊欄與資料載入的進度提示可以先顯示出來
+import cartopy.crs as ccrs
+import cartopy.feature as cfeature
+import shapely.geometry as sgeom
 
-    elapsed_at_current = elapsed  # 🆕 船抵達目前位置時，從現在算起已經過的小時數
+MAP_EXTENT = (118, 124, 21, 26)
+PLATE_CARREE = ccrs.PlateCarree()  # 共用同一個 CRS 物件，免得每個圖層都重新初始化 proj
+# 陸地格點的海流是 NaN：明確指定 bad 顏色為全透明，直接畫 NaN 陣列，不需要 MaskedArray
+CURRENT_CMAP = colormaps["Blues"].with_extremes(bad=(0, 0, 0, 0))
+# 輸出 PNG 的解析度：st.pyplot 預設 200 dpi（10x8 吋 → 2000x1600 像素），遠超過頁面實際顯示寬度；
+# 120 dpi 在寬版版面上看起來一樣清楚，Agg 要繪製的像素約少 2.8 倍
+MAP_DPI = 120
 
-    dist = 0.0
-    total_time = 0.0
-    for i in range(idx, len(path) - 1):
-        y0, x0 = path[i]
-        y1, x1 = path[i + 1]
-        seg_dist, seg_time = calc_segment(y0, x0, y1, x1, elapsed)
-        dist += seg_dist
-        total_time += seg_time
-        elapsed += seg_time
-
-    if idx < len(path) - 1:
-        y0, x0 = path[idx]
-        y1, x1 = path[idx + 1]
-        heading = np.degrees(np.arctan2(lats[y1]-lats[y0], lons[x1]-lons[x0]))
+
+@st.cache_resource
+def get_basemap_geometries(extent=MAP_EXTENT):
+    """
+    陸地/海岸線幾何只讀一次 Natural Earth shapefile，並先裁切到地圖範圍，
+    之後每次 rerun 直接重用，Cartopy 不必再對全球的頂點做投影轉換。
+    解析度：範圍小於 2° 才用 10m，台灣全島這種數度的範圍用 50m，
+    畫面上看不出差別，但每次輸出 PNG 時 Agg 要畫的海岸線頂點少了一個數量級。
+    """
+    x0, x1, y0, y1 = extent
+    scale = "10m" if max(x1 - x0, y1 - y0) < 2.0 else "50m"
+    clip = sgeom.box(x0, y0, x1, y1)
+    land = [g.intersection(clip)
+            for g in cfeature.LAND.with_scale(scale).intersecting_geometries(extent)]
+    coast = [g.intersection(clip)
+             for g in cfeature.COASTLINE.with_scale(scale).intersecting_geometries(extent)]
+    return [g for g in land if not g.is_empty], [g for g in coast if not g.is_empty]
+
+
+def _is_uniform(coords, rtol=1e-3):
+    """座標軸是否為等間距（可以直接用 imshow 畫）。"""
+    if len(coords) < 3:
+        return True
+    step = np.diff(coords)
+    return bool(np.allclose(step, step[0], rtol=rtol))
+
+
+def _build_map_figure():
+    """
+    建立地圖的靜態部分（底圖、禁航區、離岸風場、色階條）以及之後只需更新資料的動態圖層。
+    回傳的 dict 存在 session_state，rerun 時只更新動態圖層，不必重建 Figure / GeoAxes。
+    """
+    land_geoms, coast_geoms = get_basemap_geometries()
+
+    fig = Figure(figsize=(10, 8))
+    ax  = fig.add_subplot(projection=PLATE_CARREE)
+    ax.set_extent(list(MAP_EXTENT))
+    ax.add_geometries(land_geoms,  PLATE_CARREE, facecolor="#b0b0b0", edgecolor="none")
+    ax.add_geometries(coast_geoms, PLATE_CARREE, facecolor="none",    edgecolor="black")
+
+    # 海流底圖：先放全 NaN 的網格，之後用 set_array 換成對應時刻的流速。
+    # HYCOM 是等間距經緯網格，用 imshow 當成單張影像貼上，比 pcolormesh 逐格建 quad 快得多
+    empty = np.full(land_mask.shape, np.nan, dtype=np.float32)
+    if _is_uniform(lons) and _is_uniform(lats):
+        half_lon = abs(lons[1] - lons[0]) / 2 if len(lons) > 1 else 0.0
+        half_lat = abs(lats[1] - lats[0]) / 2 if len(lats) > 1 else 0.0
+        mesh = ax.imshow(empty, cmap=CURRENT_CMAP, vmin=0, vmax=1.6,
+                         origin="lower" if lats[-1] >= lats[0] else "upper",
+                         extent=[lons.min() - half_lon, lons.max() + half_lon,
+                                 lats.min() - half_lat, lats.max() + half_lat],
+                         interpolation="nearest", transform=PLATE_CARREE)
     else:
-        heading = 0
+        mesh = ax.pcolormesh(lons, lats, empty,
+                             cmap=CURRENT_CMAP, shading="auto", vmin=0, vmax=1.6,
+                             transform=PLATE_CARREE)
+    fig.colorbar(mesh, ax=ax, label="Current Speed (m/s)")
+
+    # 禁航區
+    for zone in NO_GO_ZONES:
+        poly = np.array(zone)
+        ax.fill(poly[:,1], poly[:,0], color="red",    alpha=0.4, transform=PLATE_CARREE)
+    for zone in OFFSHORE_WIND:
+        poly = np.array(zone)
+        ax.fill(poly[:,1], poly[:,0], color="yellow", alpha=0.4, transform=PLATE_CARREE)
+
+    full_line, = ax.plot([], [], color="pink", linewidth=2, transform=PLATE_CARREE)
+    done_line, = ax.plot([], [], color="red",  linewidth=2, transform=PLATE_CARREE)
+    # 船位、起點、終點合成同一個 PathCollection（依序：船 ▲、起點 ●、終點 ★），
+    # 每點各自的 marker / 顏色 / 大小，重畫時少兩個 artist 要處理
+    markers = [MarkerStyle(m) for m in ("^", "o", "*")]
+    points = ax.scatter([np.nan] * 3, [np.nan] * 3,
+                        c=["gray", "#B15BFF", "yellow"], s=[150, 80, 200],
+                        edgecolors=["gray", "black", "black"], zorder=5, transform=PLATE_CARREE)
+    points.set_paths([m.get_path().transformed(m.get_transform()) for m in markers])
 
-    return dist, total_time, heading, elapsed_at_current
+    return {
+        "fig": fig, "ax": ax, "mesh": mesh, "wave": None, "wind": None,
+        "full_line": full_line, "done_line": done_line,
+        "points": points,
+    }
 
-remaining_dist, remaining_time, heading, elapsed_at_current = calc_remaining(
-    path, st.session_state.ship_step_idx
-)
 
-# ===============================
-# 🆕 依「船目前預計時刻」取得對應的風/浪/流底圖資料
-# 這樣拖動「航行進度」滑桿時，底圖會跟著切換到船屆時對應的風浪流狀況，
-# 而不是永遠顯示「現在」這一份快照。
-# ===============================
-map_u, map_v, map_time, _map_idx = get_current_snapshot(elapsed_at_current)
-map_wave = get_wave_at(elapsed_at_current)
-map_wind = get_wind_at(elapsed_at_current)
+def _update_env_layers(art, map_speed, map_wave, map_wind):
+    """把海流底圖、波浪等高線、風場箭頭換成「船目前預計時刻」對應的資料。"""
+    ax = art["ax"]
+
+    # 海流（顯示「船目前預計時刻」對應的快照）
+    try:
+        # 流速已在載入切片時算好；陸地格點的 NaN 會自然保留，直接視為透明
+        if isinstance(art["mesh"], AxesImage):
+            art["mesh"].set_data(map_speed)
+        else:
+            art["mesh"].set_array(map_speed)
+    except Exception:
+        st.warning("Could not overlay current data.")
+
+    # 波浪等高線（同一對應時刻）：等高線無法只換資料，移除舊的再重畫
+    if art["wave"] is not None:
+        art["wave"].remove()
+        art["wave"] = None
+    if map_wave:
+        wlon_grid, wlat_grid = np.meshgrid(map_wave["lons"], map_wave["lats"])
+        contour = ax.contour(
+            wlon_grid, wlat_grid, map_wave["swh_grid"],
+            levels=[1.0, 1.5, 2.0, 2.5, 3.0, 3.5, 4.0],
+            cmap="cool", linewidths=1.2,
+            transform=PLATE_CARREE
+        )
+        ax.clabel(contour, fmt="%.1fm", fontsize=7, inline=True)
+        art["wave"] = contour
+
+    # 風場箭頭（同一對應時刻）：網格相同時只換 U/V
+    if map_wind:
+        u_q = map_wind["u"][::2, ::2]
+        v_q = map_wind["v"][::2, ::2]
+        if art["wind"] is None or art["wind"].N != u_q.size:
+            if art["wind"] is not None:
+                art["wind"].remove()
+            wlon_g, wlat_g = np.meshgrid(map_wind["lons"], map_wind["lats"])
+            art["wind"] = ax.quiver(wlon_g[::2, ::2], wlat_g[::2, ::2], u_q, v_q,
+                                    scale=200, color="white", alpha=0.5,
+                                    transform=PLATE_CARREE)
+        else:
+            art["wind"].set_UVC(u_q, v_q)
+        art["wind"].set_visible(True)
+    elif art["wind"] is not None:
+        art["wind"].set_visible(False)
+
+
+# Figure 存在各自的 session_state（不用 cache_resource，避免多個使用者同時改同一張圖）；
+# HYCOM 網格改變時才重建
+map_fig_key = (len(lons), len(lats), float(lons[0]), float(lats[0]))
+if st.session_state.get("map_fig_key") != map_fig_key:
+    st.session_state.map_artists = _build_map_figure()
+    st.session_state.map_fig_key = map_fig_key
 
 # ===============================
-# Dashboard — 第一排
+# 航行進度面板 — 包成 fragment：拖動進度滑桿只重跑這一塊，
+# 不會重新執行上面的資料載入、網格前處理與航線規劃
 # ===============================
-st.subheader("Navigation Dashboard")
-c1, c2, c3, c4 = st.columns(4)
-c1.metric("Remaining Distance (km)", f"{remaining_dist:.2f}")
-c2.metric("Remaining Time (hr)",     f"{remaining_time:.2f}")
-c3.metric("Heading",                 f"{heading:.1f}°")
-c4.metric("目前預計航行時數",         f"{elapsed_at_current:.2f} hr")
-
-# 第二排 — 氣象資料（依目前位置對應的時刻）
-w1, w2, w3 = st.columns(3)
-if map_wave:
-    wi = np.abs(map_wave["lats"] - lats[current_pos[0]]).argmin()
-    wj = np.abs(map_wave["lons"] - lons[current_pos[1]]).argmin()
-    swh_here = map_wave["swh_grid"][wi, wj]
-    w1.metric("顯著波高（目前位置）", f"{swh_here:.2f} m" if not np.isnan(swh_here) else "N/A")
-    if map_wave.get("dirpw_grid") is not None:
-        dirpw_here = map_wave["dirpw_grid"][wi, wj]
-        w2.metric("波浪方向（目前位置）", f"{dirpw_here:.1f}°" if not np.isnan(dirpw_here) else "N/A")
+@st.fragment
+def navigation_panel():
+    progress_pct = st.slider("航行進度 (%)", 0, 100, 0, key="progress_slider")
+    st.caption("拖動上方滑桿即可查看船舶航行至該進度時，對應時刻的風/浪/流底圖與剩餘資訊。")
+
+    st.session_state.ship_step_idx = int((progress_pct / 100) * (len(path) - 1))
+    current_pos = path[st.session_state.ship_step_idx]
+
+    remaining_dist, remaining_time, heading, elapsed_at_current = calc_remaining(
+        st.session_state.ship_step_idx, st.session_state.voyage
+    )
+
+    # ===============================
+    # 🆕 依「船目前預計時刻」取得對應的風/浪/流底圖資料
+    # 這樣拖動「航行進度」滑桿時，底圖會跟著切換到船屆時對應的風浪流狀況，
+    # 而不是永遠顯示「現在」這一份快照。
+    # ===============================
+    map_speed, map_time, _map_idx = get_current_snapshot(elapsed_at_current)
+    map_wave = get_wave_at(elapsed_at_current)
+    map_wind = get_wind_at(elapsed_at_current)
+
+    # ===============================
+    # Dashboard — 第一排
+    # ===============================
+    st.subheader("Navigation Dashboard")
+    c1, c2, c3, c4 = st.columns(4)
+    c1.metric("Remaining Distance (km)", f"{remaining_dist:.2f}")
+    c2.metric("Remaining Time (hr)",     f"{remaining_time:.2f}")
+    c3.metric("Heading",                 f"{heading:.1f}°")
+    c4.metric("目前預計航行時數",         f"{elapsed_at_current:.2f} hr")
+
+    # 第二排 — 氣象資料（依目前位置對應的時刻）
+    w1, w2, w3 = st.columns(3)
+    if map_wave:
+        wi = map_wave["yi"][current_pos[0]]
+        wj = map_wave["xj"][current_pos[1]]
+        swh_here = map_wave["swh_grid"][wi, wj]
+        w1.metric("顯著波高（目前位置）", f"{swh_here:.2f} m" if not np.isnan(swh_here) else "N/A")
+        if map_wave.get("dirpw_grid") is not None:
+            dirpw_here = map_wave["dirpw_grid"][wi, wj]
+            w2.metric("波浪方向（目前位置）", f"{dirpw_here:.1f}°" if not np.isnan(dirpw_here) else "N/A")
+        else:
+            w2.metric("波浪方向（目前位置）", "N/A")
     else:
+        w1.metric("顯著波高（目前位置）", "N/A")
         w2.metric("波浪方向（目前位置）", "N/A")
-else:
-    w1.metric("顯著波高（目前位置）", "N/A")
-    w2.metric("波浪方向（目前位置）", "N/A")
-
-if map_wind:
-    wi = np.abs(map_wind["lats"] - lats[current_pos[0]]).argmin()
-    wj = np.abs(map_wind["lons"] - lons[current_pos[1]]).argmin()
-    spd_here = float(map_wind["speed"][wi, wj])
-    w3.metric("風速（目前位置）", f"{spd_here:.2f} m/s")
-else:
-    w3.metric("風速（目前位置）", "N/A")
-
-st.caption(
-    f"HYCOM/GFS 對應時刻（船抵達目前位置時預估）: {map_time} ｜ "
-    f"已載入海流 {len(hycom_times_rel)} 個時間切片（涵蓋未來 {HYCOM_FORECAST_HOURS} 小時）、"
-    f"風浪 {len(weather_series['times_rel']) if weather_series else 0} 個時間切片"
-    f"（每 {WEATHER_STEP_HOURS} 小時一筆，涵蓋未來 {WEATHER_FORECAST_HOURS} 小時）"
-)
-st.caption(f"離岸安全距離：約 {COAST_SAFE_KM} km（換算約 {COAST_SAFE_CELLS:.1f} 個網格，每格約 {CELL_KM:.1f} km）")
 
-# ===============================
-# Map — 底圖依「船目前預計時刻」對應的風/浪/流資料繪製
-# ===============================
-fig = plt.figure(figsize=(10, 8))
-ax  = plt.axes(projection=ccrs.PlateCarree())
-ax.set_extent([118, 124, 21, 26])
-ax.add_feature(cfeature.LAND,       facecolor="#b0b0b0")
-ax.add_feature(cfeature.COASTLINE)
-
-# 海流（顯示「船目前預計時刻」對應的快照）
-try:
-    speed_cur = np.sqrt(map_u**2 + map_v**2)
-    mesh = ax.pcolormesh(lons, lats, speed_cur,
-                         cmap="Blues", shading="auto", vmin=0, vmax=1.6,
-                         transform=ccrs.PlateCarree())
-    fig.colorbar(mesh, ax=ax, label="Current Speed (m/s)")
-except Exception:
-    st.warning("Could not overlay current data.")
-
-# 波浪等高線（同一對應時刻）
-if map_wave:
-    wlon_grid, wlat_grid = np.meshgrid(map_wave["lons"], map_wave["lats"])
-    contour = ax.contour(
-        wlon_grid, wlat_grid, map_wave["swh_grid"],
-        levels=[1.0, 1.5, 2.0, 2.5, 3.0, 3.5, 4.0],
-        cmap="cool", linewidths=1.2,
-        transform=ccrs.PlateCarree()
+    if map_wind:
+        wi = map_wind["yi"][current_pos[0]]
+        wj = map_wind["xj"][current_pos[1]]
+        spd_here = float(map_wind["speed"][wi, wj])
+        w3.metric("風速（目前位置）", f"{spd_here:.2f} m/s")
+    else:
+        w3.metric("風速（目前位置）", "N/A")
+
+    st.caption(
+        f"HYCOM/GFS 對應時刻（船抵達目前位置時預估）: {map_time} ｜ "
+        f"已載入海流 {len(hycom_times_rel)} 個時間切片（涵蓋未來 {HYCOM_FORECAST_HOURS} 小時）、"
+        f"風浪 {len(weather_series['times_rel']) if weather_series else 0} 個時間切片"
+        f"（每 {WEATHER_STEP_HOURS} 小時一筆，涵蓋未來 {WEATHER_FORECAST_HOURS} 小時）"
+    )
+    st.caption(f"離岸安全距離：約 {COAST_SAFE_KM} km（換算約 {COAST_SAFE_CELLS:.1f} 個網格，每格約 {CELL_KM:.1f} km）")
+
+    art = st.session_state.map_artists
+    fig, ax = art["fig"], art["ax"]
+
+    # 風浪流圖層只在對應的預報時刻改變時才更新；
+    # 滑桿移動但仍落在同一個時間切片內時，只需移動船位與航跡
+    weather_idx = (nearest_time_idx(weather_series["times_list"], elapsed_at_current)
+                   if weather_series else None)
+    env_key = (
+        str(map_time),
+        (weather_series["date"], weather_series["cycle"], weather_idx) if weather_series else None,
     )
-    ax.clabel(contour, fmt="%.1fm", fontsize=7, inline=True)
-
-# 風場箭頭（同一對應時刻）
-if map_wind:
-    wlon_g, wlat_g = np.meshgrid(map_wind["lons"], map_wind["lats"])
-    ax.quiver(wlon_g[::2, ::2], wlat_g[::2, ::2],
-              map_wind["u"][::2, ::2], map_wind["v"][::2, ::2],
-              scale=200, color="white", alpha=0.5,
-              transform=ccrs.PlateCarree())
-
-# 禁航區
-for zone in NO_GO_ZONES:
-    poly = np.array(zone)
-    ax.fill(poly[:,1], poly[:,0], color="red",    alpha=0.4, transform=ccrs.PlateCarree())
-for zone in OFFSHORE_WIND:
-    poly = np.array(zone)
-    ax.fill(poly[:,1], poly[:,0], color="yellow", alpha=0.4, transform=ccrs.PlateCarree())
-
-# 路徑
-full_lons = [lons[p[1]] for p in path]
-full_lats = [lats[p[0]] for p in path]
-ax.plot(full_lons, full_lats, color="pink",  linewidth=2, transform=ccrs.PlateCarree())
-
-done_lons = full_lons[:st.session_state.ship_step_idx+1]
-done_lats = full_lats[:st.session_state.ship_step_idx+1]
-ax.plot(done_lons, done_lats, color="red", linewidth=2, transform=ccrs.PlateCarree())
-
-ax.scatter(lons[current_pos[1]], lats[current_pos[0]],
-           color="gray", marker="^", s=150, zorder=5, transform=ccrs.PlateCarree())
-ax.scatter(s_lon, s_lat, color="#B15BFF", s=80,  edgecolors="black", transform=ccrs.PlateCarree())
-ax.scatter(e_lon, e_lat, color="yellow",  marker="*", s=200, edgecolors="black", transform=ccrs.PlateCarree())
-
-plt.title(f"HELIOS Navigation Map ｜ 對應時刻: {map_time}")
-st.pyplot(fig)
+    if art.get("env_key") != env_key:
+        _update_env_layers(art, map_speed, map_wave, map_wind)
+        art["env_key"] = env_key
+
+    # 同一份航線、同一個預報時刻、同一個船位畫出來的圖完全相同（例如改了不影響地圖的設定而 rerun），
+    # 直接重送上次輸出的 PNG，不必再走一次 Agg 繪圖與 savefig
+    frame_key = (voyage_key, env_key, st.session_state.ship_step_idx)
+    if art.get("frame_key") != frame_key:
+        # 路徑
+        full_lons = st.session_state.path_lons
+        full_lats = st.session_state.path_lats
+        art["full_line"].set_data(full_lons, full_lats)
+
+        done_lons = full_lons[:st.session_state.ship_step_idx+1]
+        done_lats = full_lats[:st.session_state.ship_step_idx+1]
+        art["done_line"].set_data(done_lons, done_lats)
+
+        art["points"].set_offsets([[lons[current_pos[1]], lats[current_pos[0]]],
+                                   [s_lon, s_lat],
+                                   [e_lon, e_lat]])
+
+        ax.set_title(f"HELIOS Navigation Map ｜ 對應時刻: {map_time}")
+        # Figure 會在下次 rerun 重用，不清掉
+        buf = io.BytesIO()
+        fig.savefig(buf, format="png", bbox_inches="tight", dpi=MAP_DPI)
+        art["png"] = buf.getvalue()
+        art["frame_key"] = frame_key
+    st.image(art["png"], width="stretch")  # 與 st.pyplot 預設一樣撐滿欄寬
+
+
+navigation_panel()